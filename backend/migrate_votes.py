@@ -0,0 +1,51 @@
+"""
+One-off backfill of poll votes from the legacy polls.votes JSONB column
+into the votes table, for databases created before votes got their own table
+Run with: python migrate_votes.py
+"""
+from sqlalchemy import text
+from main import SQLModel
+from db import DATABASE_URL, get_engine
+
+engine = get_engine(DATABASE_URL)
+
+# Legacy layout: {"<option_id>": [{"member_id": 1, "emoji": "👍"}, ...]}.
+# Polls that already have rows in votes are skipped, so re-running is safe.
+BACKFILL_SQL = text("""
+    INSERT INTO votes (poll_id, option_id, member_id, emoji, created_at)
+    SELECT p.id, o.key, (v.value->>'member_id')::int, v.value->>'emoji', p.created_at
+    FROM polls p
+    CROSS JOIN LATERAL jsonb_each(p.votes) AS o(key, value)
+    CROSS JOIN LATERAL jsonb_array_elements(o.value) WITH ORDINALITY AS v(value, position)
+    WHERE jsonb_typeof(p.votes) = 'object'
+      AND jsonb_typeof(o.value) = 'array'
+      AND v.value ? 'member_id'
+      AND NOT EXISTS (SELECT 1 FROM votes WHERE votes.poll_id = p.id)
+    ORDER BY p.id, o.key, v.position
+""")
+
+LEGACY_COLUMN_SQL = text("""
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'polls' AND column_name = 'votes'
+""")
+
+def migrate_votes():
+    if engine.dialect.name != "postgresql":
+        print("Legacy votes only exist on PostgreSQL databases, nothing to do.")
+        return
+
+    SQLModel.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        if conn.execute(LEGACY_COLUMN_SQL).first() is None:
+            print("No polls.votes column found, nothing to do.")
+            return
+        copied = conn.execute(BACKFILL_SQL).rowcount
+
+    print(f"✅ Copied {copied} votes into the votes table.")
+    print("Once the app shows them, the legacy column can be dropped with:")
+    print("    ALTER TABLE polls DROP COLUMN votes;")
+
+
+if __name__ == "__main__":
+    migrate_votes()
@@ -1,30 +1,59 @@
+import asyncio
+import os
+import httpx
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, create_engine, SQLModel
-from sqlmodel.pool import StaticPool
-from main import app, get_session
-
-# Test database setup
-@pytest.fixture(name="session")
-def session_fixture():
-    engine = create_engine(
-        "sqlite:///:memory:",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
-    )
-    SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
-        yield session
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import DateTime, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+import main
+from db import get_async_engine
+from main import ChatMessage, Group, Member, Suggestion, app, get_http_client, get_session
+
+# Test database setup: tables are created once per run and emptied after each test
+@pytest.fixture(name="engine", scope="session")
+def engine_fixture():
+    engine = get_async_engine("sqlite+aiosqlite://")
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    asyncio.run(create_tables())
+    yield engine
+
+@pytest.fixture(name="test_client", scope="session")
+def test_client_fixture():
+    # Not entered as a context manager: the app's lifespan would connect to
+    # the real database, while tests swap in the engine above per test.
+    return TestClient(app)
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
-    def get_session_override():
-        return session
+def client_fixture(engine, test_client, monkeypatch):
+    session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    # Background tasks open their own sessions from main.SessionLocal
+    monkeypatch.setattr(main, "SessionLocal", session_factory)
+
+    async def get_session_override():
+        async with session_factory() as session:
+            yield session
+    
+    # Lifespan never runs, so app.state.http is unset; outbound calls hit a stub
+    http = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(503)))
     
     app.dependency_overrides[get_session] = get_session_override
-    client = TestClient(app)
-    yield client
+    app.dependency_overrides[get_http_client] = lambda: http
+    yield test_client
     app.dependency_overrides.clear()
+    asyncio.run(http.aclose())
+
+    async def clear_tables():
+        async with engine.begin() as conn:
+            for table in reversed(SQLModel.metadata.sorted_tables):
+                await conn.execute(table.delete())
+
+    asyncio.run(clear_tables())
 
 def test_root(client: TestClient):
     """Test root endpoint"""
@@ -46,6 +75,24 @@ def test_create_group(client: TestClient):
     assert data["group"]["name"] == "Test Group"
     assert data["group"]["mood"] == "chill"
 
+def test_create_group_code_collision(client: TestClient, monkeypatch):
+    """Test that a colliding group code is retried with a fresh one"""
+    taken = client.post("/group", json={"name": "First"}).json()["code"]
+    codes = iter([taken, "FRESH1"])
+    monkeypatch.setattr(main, "generate_code", lambda: next(codes))
+
+    response = client.post("/group", json={"name": "Second"})
+    assert response.status_code == 200
+    assert response.json()["code"] == "FRESH1"
+
+def test_create_group_code_exhausted(client: TestClient, monkeypatch):
+    """Test 503 when every generated group code collides"""
+    taken = client.post("/group", json={"name": "First"}).json()["code"]
+    monkeypatch.setattr(main, "generate_code", lambda: taken)
+
+    response = client.post("/group", json={"name": "Second"})
+    assert response.status_code == 503
+
 def test_join_group(client: TestClient):
     """Test joining a group"""
     # Create group first
@@ -57,7 +104,7 @@ def test_join_group(client: TestClient):
     
     # Join the group
     response = client.post(
-        f"/group/{code}/join",
+        app.url_path_for("join_group", code=code),
         json={"name": "Test User", "lat": 12.9716, "lng": 77.5946}
     )
     assert response.status_code == 200
@@ -75,18 +122,103 @@ def test_get_group(client: TestClient):
     code = create_response.json()["code"]
     
     client.post(
-        f"/group/{code}/join",
+        app.url_path_for("join_group", code=code),
         json={"name": "User 1", "lat": 12.9716, "lng": 77.5946}
     )
     
     # Get group
-    response = client.get(f"/group/{code}")
+    response = client.get(app.url_path_for("get_group", code=code))
     assert response.status_code == 200
     data = response.json()
     assert data["group"]["name"] == "Test Group"
     assert len(data["members"]) == 1
     assert data["members"][0]["name"] == "User 1"
 
+def test_get_group_etag(client: TestClient):
+    """Test conditional GET on group details"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    code = create_response.json()["code"]
+    
+    response = client.get(app.url_path_for("get_group", code=code))
+    etag = response.headers["etag"]
+    
+    # Unchanged group is served as 304
+    response = client.get(app.url_path_for("get_group", code=code), headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    
+    # A new member changes the ETag
+    client.post(app.url_path_for("join_group", code=code), json={"name": "User 1"})
+    response = client.get(app.url_path_for("get_group", code=code), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()["members"]) == 1
+
+def test_create_suggestions(client: TestClient):
+    """Test fetching suggestions from several sources at once"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    code = create_response.json()["code"]
+    client.post(
+        app.url_path_for("join_group", code=code),
+        json={"name": "User 1", "lat": 12.9716, "lng": 77.5946}
+    )
+    
+    response = client.post(
+        app.url_path_for("create_suggestions", code=code),
+        params=[("source", "google"), ("source", "tmdb")]
+    )
+    assert response.status_code == 200
+    suggestions = response.json()["suggestions"]
+    assert len(suggestions) == 8
+    assert sorted(s["type"] for s in suggestions) == ["movie"] * 4 + ["place"] * 4
+    assert all(s["id"] for s in suggestions)
+    
+    stored = client.get(app.url_path_for("get_suggestions", code=code)).json()
+    assert len(stored) == 8
+
+def test_create_suggestions_unknown_source(client: TestClient):
+    """Test that an unknown source yields no suggestions"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    code = create_response.json()["code"]
+    
+    response = client.post(
+        app.url_path_for("create_suggestions", code=code),
+        params={"source": "nope"}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"suggestions": []}
+
+def test_get_suggestions_etag(client: TestClient):
+    """Test conditional GET on suggestions"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    code = create_response.json()["code"]
+    
+    response = client.get(app.url_path_for("get_suggestions", code=code))
+    assert response.json() == []
+    etag = response.headers["etag"]
+    
+    # Unchanged suggestions are served as 304
+    response = client.get(app.url_path_for("get_suggestions", code=code), headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    
+    # New suggestions change the ETag
+    client.post(app.url_path_for("create_suggestions", code=code))
+    response = client.get(app.url_path_for("get_suggestions", code=code), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()) == 4
+
 def test_create_poll(client: TestClient):
     """Test poll creation"""
     # Create group
@@ -98,7 +230,7 @@ def test_create_poll(client: TestClient):
     
     # Create poll
     response = client.post(
-        f"/group/{code}/polls",
+        app.url_path_for("create_poll", code=code),
         json={
             "title": "Where to go?",
             "options": [
@@ -112,35 +244,42 @@ def test_create_poll(client: TestClient):
     assert data["title"] == "Where to go?"
     assert len(data["options"]["options"]) == 2
 
-def test_vote_on_poll(client: TestClient):
+@pytest.mark.asyncio
+async def test_vote_on_poll(client: TestClient):
     """Test voting on a poll"""
-    # Setup: create group, join, create poll
-    create_response = client.post(
-        "/group",
-        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
-    )
-    code = create_response.json()["code"]
-    
-    join_response = client.post(
-        f"/group/{code}/join",
-        json={"name": "Voter", "lat": 12.9716, "lng": 77.5946}
-    )
-    member_id = join_response.json()["member"]["id"]
-    
-    poll_response = client.post(
-        f"/group/{code}/polls",
-        json={
-            "title": "Test Poll",
-            "options": [{"id": "opt1", "title": "Option 1"}]
-        }
-    )
-    poll_id = poll_response.json()["id"]
-    
-    # Vote
-    response = client.post(
-        f"/group/{code}/polls/{poll_id}/vote",
-        json={"member_id": member_id, "option_id": "opt1", "emoji": "👍"}
-    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+        # Setup: create group, then join and create poll concurrently
+        create_response = await ac.post(
+            "/group",
+            json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+        )
+        code = create_response.json()["code"]
+        
+        # The requests only overlap at the ASGI level: the StaticPool test
+        # engine has one connection, so their transactions share it. This
+        # saves a round trip; it says nothing about DB-level concurrency.
+        join_response, poll_response = await asyncio.gather(
+            ac.post(
+                app.url_path_for("join_group", code=code),
+                json={"name": "Voter", "lat": 12.9716, "lng": 77.5946}
+            ),
+            ac.post(
+                app.url_path_for("create_poll", code=code),
+                json={
+                    "title": "Test Poll",
+                    "options": [{"id": "opt1", "title": "Option 1"}]
+                }
+            )
+        )
+        member_id = join_response.json()["member"]["id"]
+        poll_id = poll_response.json()["id"]
+        
+        # Vote
+        response = await ac.post(
+            app.url_path_for("vote_poll", code=code, poll_id=poll_id),
+            json={"member_id": member_id, "option_id": "opt1", "emoji": "👍"}
+        )
     assert response.status_code == 200
     data = response.json()
     assert "opt1" in data["votes"]
@@ -151,6 +290,21 @@ def test_group_not_found(client: TestClient):
     response = client.get("/group/NOTEXIST")
     assert response.status_code == 404
 
+def test_bot_query(client: TestClient):
+    """Test direct bot query"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    group_id = create_response.json()["group"]["id"]
+    
+    response = client.post("/bot/query", json={"group_id": group_id, "text": "suggest"})
+    assert response.status_code == 200
+    assert response.json()["reply"].startswith("No suggestions")
+    
+    response = client.post("/bot/query", json={"group_id": group_id + 1000, "text": "suggest"})
+    assert response.status_code == 404
+
 @pytest.mark.asyncio
 async def test_chat_with_planpal(client: TestClient):
     """Test chat with PlanPal mention"""
@@ -163,17 +317,103 @@ async def test_chat_with_planpal(client: TestClient):
     
     # Join
     join_response = client.post(
-        f"/group/{code}/join",
+        app.url_path_for("join_group", code=code),
         json={"name": "Chatter"}
     )
     member_id = join_response.json()["member"]["id"]
     
     # Chat with PlanPal
     response = client.post(
-        f"/group/{code}/chat",
+        app.url_path_for("post_chat", code=code),
         json={"member_id": member_id, "message": "@PlanPal suggest"}
     )
     assert response.status_code == 200
     data = response.json()
     assert data["ok"] is True
-    assert data["bot_response"] is not None
+    
+    # PlanPal replies in the background as a message without a member
+    messages = client.get(app.url_path_for("get_chat", code=code)).json()
+    assert len(messages) == 2
+    assert messages[0]["member_id"] == member_id
+    assert messages[1]["member_id"] is None
+
+def test_group_websocket(client: TestClient):
+    """Test multiplexed requests over the group websocket"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    code = create_response.json()["code"]
+    
+    join_response = client.post(
+        app.url_path_for("join_group", code=code),
+        json={"name": "Chatter"}
+    )
+    member_id = join_response.json()["member"]["id"]
+    
+    with client.websocket_connect(app.url_path_for("group_socket", code=code)) as websocket:
+        websocket.send_json({"id": 1, "op": "get"})
+        frame = websocket.receive_json()
+        assert frame["id"] == 1
+        assert frame["result"]["group"]["code"] == code
+        
+        websocket.send_json({"id": 2, "op": "chat", "member_id": member_id, "message": "@PlanPal suggest"})
+        assert websocket.receive_json() == {"id": 2, "result": {"ok": True}}
+        assert websocket.receive_json()["event"] == "bot_response"
+        
+        websocket.send_json({"id": 3, "op": "nope"})
+        assert "error" in websocket.receive_json()
+
+def test_group_websocket_bad_frames(client: TestClient):
+    """Test that malformed websocket frames get error frames instead of closing the socket"""
+    create_response = client.post(
+        "/group",
+        json={"name": "Test Group", "mood": "chill", "budget_level": "low"}
+    )
+    code = create_response.json()["code"]
+    
+    with client.websocket_connect(app.url_path_for("group_socket", code=code)) as websocket:
+        websocket.send_text("not json")
+        assert websocket.receive_json() == {"id": None, "error": "Invalid JSON"}
+        
+        websocket.send_json([1, 2])
+        assert websocket.receive_json() == {"id": None, "error": "Frame must be a JSON object"}
+        
+        # The connection is still usable afterwards
+        websocket.send_json({"id": 1, "op": "get"})
+        assert websocket.receive_json()["result"]["group"]["code"] == code
+
+def test_timestamp_defaults_match_columns():
+    """Test that timestamp defaults match their column's time zone setting"""
+    # asyncpg rejects aware datetimes for TIMESTAMP WITHOUT TIME ZONE (and
+    # vice versa); SQLite accepts both, so check the contract directly
+    for table in SQLModel.metadata.sorted_tables:
+        for column in table.columns:
+            if isinstance(column.type, DateTime) and column.default is not None:
+                value = column.default.arg(None)
+                assert (value.tzinfo is not None) == column.type.timezone, column
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL not set")
+def test_postgres_inserts():
+    """Test ORM and Core inserts through the asyncpg dialect"""
+    engine = get_async_engine(os.environ["TEST_POSTGRES_URL"])
+
+    async def run():
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        # Everything is rolled back, so the database is left untouched
+        async with engine.connect() as conn:
+            transaction = await conn.begin()
+            session = AsyncSession(bind=conn, expire_on_commit=False)
+            group = Group(code="PGTEST", name="Postgres Test")
+            session.add(group)
+            await session.flush()
+            session.add(Member(group_id=group.id, name="Member"))
+            session.add(ChatMessage(group_id=group.id, message="Hello"))
+            await session.flush()
+            await session.exec(insert(Suggestion), params=[{"group_id": group.id, "type": "place", "title": "Park"}])
+            await session.close()
+            await transaction.rollback()
+        await engine.dispose()
+
+    asyncio.run(run())